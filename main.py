@@ -1,12 +1,27 @@
 # main.py  — 指定プロンプト・F/G列反映版
+import functools
+import hashlib
 import os
+import random
+import re
+import sqlite3
 import sys
+import time
 import json
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from dateutil import parser as duparser
 
+# 高速な日時パーサ（任意）
+try:
+    from ciso8601 import parse_datetime as _ciso_parse  # pip install ciso8601
+except Exception:
+    _ciso_parse = None
+
 import gspread
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 高精度なUnicode正規表現（任意）
 try:
@@ -14,6 +29,19 @@ try:
 except Exception:
     re_u = None
 
+# H列正規化で除去する記号類（ホット関数内で毎回コンパイルしないよう事前コンパイル）
+if re_u:
+    # \p{P}=句読点, \p{S}=記号, \p{Z}=区切り（スペース等）, \p{Cc}=制御
+    _DUP_STRIP_RE = re_u.compile(r'[\p{P}\p{S}\p{Z}\p{Cc}]+')
+else:
+    _DASH_CHARS = r'\-\u2212\u2010\u2011\u2012\u2013\u2014\u2015\uFF0D\u30FC\uFF70'
+    _DUP_STRIP_RE = re.compile(
+        r'[\s"\'\u201C\u201D\u2018\u2019\(\)\[\]{}<>]'              # 空白と各種引用符・半角括弧
+        r'|[、。・,…:;!?！？／/\\|＋+＊*.,]'                       # 句読点・記号
+        r'|[【】＜＞「」『』《》〔〕［］｛｝（）]'               # 全角括弧
+        r'|[' + _DASH_CHARS + r']'                                   # ハイフン・ダッシュ・長音
+    )
+
 # 半角統一用
 import unicodedata
 try:
@@ -21,6 +49,47 @@ try:
 except Exception:
     jaconv = None
 
+# jaconv.z2h は毎回Pythonレベルで1文字ずつ処理するため、カタカナ・記号ブロックの
+# 全角→半角対応を一度だけ引いて str.translate 用テーブルに固める（NFKC後に適用。
+# 英数字は NFKC が先に半角化するのでテーブルはカタカナ等だけで足りる）
+if jaconv is not None:
+    _Z2H_KANA_TABLE = {
+        cp: jaconv.z2h(chr(cp), kana=True, digit=True, ascii=True)
+        for cp in range(0x3000, 0x3100)
+        if jaconv.z2h(chr(cp), kana=True, digit=True, ascii=True) != chr(cp)
+    }
+else:
+    _Z2H_KANA_TABLE = None
+
+# 記号除去は「削除のみ」なので、正規表現より速い str.translate 用の削除テーブルを使う。
+# BMP 範囲（ニュース見出しにはほぼ十分）のみ事前計算し、BMP 外（絵文字等）を含む
+# 稀なタイトルだけ _DUP_STRIP_RE にフォールバックする。
+_DEL_TABLE = {
+    cp: None
+    for cp in range(0x10000)
+    if unicodedata.category(chr(cp))[0] in ("P", "S", "Z")
+    or unicodedata.category(chr(cp)) == "Cc"
+}
+
+# 高速JSON（任意）
+try:
+    import orjson  # pip install orjson
+except Exception:
+    orjson = None
+
+if orjson is not None:
+    def _json_loads(s):
+        return orjson.loads(s)
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    def _json_loads(s):
+        return json.loads(s)
+
+    def _json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False)
+
 # Gemini（任意）
 try:
     import google.generativeai as genai
@@ -48,6 +117,17 @@ OUTPUT_HEADERS = [
     "ポジネガ", "カテゴリ", "重複確認用タイトル", "有料カテゴリ"
 ]
 
+# H列正規化ルールのバージョン。ルールを変えたら上げる（Z1セルに記録して
+# 変更が無い日のH列全行書き換えをスキップする）
+NORM_VERSION = "v3"
+
+# Gemini分類結果のローカルキャッシュ（正規化タイトル単位）。
+# 再実行や日をまたいで再登場するタイトルの再分類を省く
+GEMINI_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "news_ai", "gemini.sqlite"
+)
+GEMINI_CACHE_TTL_DAYS = 30
+
 JST = ZoneInfo("Asia/Tokyo")
 
 
@@ -68,27 +148,93 @@ def calc_time_window(now_jst: datetime):
     return start, end
 
 
+# Gemini に構造化JSONを強制する設定（正規表現でのJSON救出が不要になる）
+_GEMINI_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "row": {"type": "INTEGER"},
+                "sentiment": {"type": "STRING"},
+                "category": {"type": "STRING"},
+            },
+            "required": ["row", "sentiment", "category"],
+        },
+    },
+    "temperature": 0,  # 再現性を優先
+}
+
+# 投稿日の既知書式（dateutil の fuzzy パースは遅いので先に判定して高速パスへ）
+_COMPACT_DT_RE = re.compile(r'^\d{2}/\d{1,2}/\d{1,2} \d{1,2}:\d{2}$')
+_ISO_DT_RE = re.compile(r'^\d{4}[-/]\d{1,2}[-/]\d{1,2}[ T]\d{1,2}:\d{2}(:\d{2})?$')
+
+
 def parse_sheet_datetime_to_jst(val):
     """
     C列「投稿日」を JST の datetime に変換。
-    - 数値（シリアル）：1899-12-30 起点→JST
-    - 文字列：dateutilで柔軟パース（TZ無→JST想定）
+    - 数値（シリアル）：1899-12-30 起点のシート現地時刻（＝JST壁時計）として解釈
+    - 既知書式の文字列：strptime / fromisoformat で高速パース
+    - その他の文字列：dateutilで柔軟パース（TZ無→JST想定）
     """
-    if val is None or str(val).strip() == "":
+    if val is None:
         return None
 
-    # 数値シリアル
-    try:
-        serial = float(val)
-        base = datetime(1899, 12, 30, tzinfo=timezone.utc)
-        dt_utc = base + timedelta(days=serial)
-        return dt_utc.astimezone(JST)
-    except Exception:
-        pass
+    # UNFORMATTED_VALUE 読みではシリアル値が float/int のまま届く（文字列化せず即変換）
+    # シリアルはTZ情報を持たないシートの表示時刻なので、そのままJSTを付ける
+    if isinstance(val, (int, float)):
+        base = datetime(1899, 12, 30)
+        return (base + timedelta(days=val)).replace(tzinfo=JST)
+
+    s = str(val).strip()
+    if s == "":
+        return None
 
-    # 文字列
+    # 数値シリアル（'/' や '-' を含むものは日付文字列なのでスキップ）
+    if "/" not in s and "-" not in s:
+        try:
+            serial = float(s)
+            base = datetime(1899, 12, 30)
+            return (base + timedelta(days=serial)).replace(tzinfo=JST)
+        except Exception:
+            pass
+
+    # 高速パス1: 本パイプラインが出力する `25/8/20 15:01` 形式
+    if _COMPACT_DT_RE.match(s):
+        try:
+            return datetime.strptime(s, "%y/%m/%d %H:%M").replace(tzinfo=JST)
+        except ValueError:
+            pass
+
+    # 高速パス2: ISO風 `2025-08-20 15:01(:00)` / 入力シートの `2025/8/20 15:01`
+    if _ISO_DT_RE.match(s):
+        try:
+            return datetime.fromisoformat(s.replace("/", "-")).replace(tzinfo=JST)
+        except ValueError:
+            pass
+        # ゼロ埋め無し（fromisoformat が拒否）は strptime で拾う
+        for fmt in ("%Y/%m/%d %H:%M", "%Y/%m/%d %H:%M:%S",
+                    "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"):
+            try:
+                return datetime.strptime(s, fmt).replace(tzinfo=JST)
+            except ValueError:
+                continue
+
+    # ISO風の残り（TZ付き等）は C実装の ciso8601 で先に試す
+    if _ciso_parse is not None:
+        try:
+            dt = _ciso_parse(s)
+        except Exception:
+            dt = None
+        if dt is not None:
+            if dt.tzinfo is None:
+                return dt.replace(tzinfo=JST)
+            return dt.astimezone(JST)
+
+    # 文字列（フォールバック）
     try:
-        dt = duparser.parse(str(val), fuzzy=True)
+        dt = duparser.parse(s, fuzzy=True)
         if dt.tzinfo is None:
             dt = dt.replace(tzinfo=JST)
         else:
@@ -106,6 +252,7 @@ def format_compact_jst(dt: datetime) -> str:
 
 
 # --- 文字種の半角統一（カタカナ・数字・英字） ---
+@functools.lru_cache(maxsize=50000)
 def to_hankaku_kana_ascii_digit(s: str) -> str:
     """
     ・数字/英字は NFKC で全角→半角へ
@@ -117,13 +264,13 @@ def to_hankaku_kana_ascii_digit(s: str) -> str:
     # 数字・英字は NFKC で半角化（全角→ASCII）
     s_nfkc = unicodedata.normalize("NFKC", s)
 
-    # カタカナ半角化（可能なら）
-    if jaconv is not None:
-        # ascii/digit も True にして安全側で全半角混在を解消
-        s_nfkc = jaconv.z2h(s_nfkc, kana=True, digit=True, ascii=True)
+    # カタカナ半角化（可能なら。事前計算テーブルで1パス変換）
+    if _Z2H_KANA_TABLE is not None:
+        s_nfkc = s_nfkc.translate(_Z2H_KANA_TABLE)
     return s_nfkc
 
 
+@functools.lru_cache(maxsize=50000)
 def normalize_title_for_dup(s: str) -> str:
     """
     H列（重複確認用）生成：
@@ -137,22 +284,10 @@ def normalize_title_for_dup(s: str) -> str:
     # 1) 半角統一
     s = to_hankaku_kana_ascii_digit(s)
 
-    # 2) 記号類の除去
-    if re_u:
-        # \p{P}=句読点, \p{S}=記号, \p{Z}=区切り（スペース等）, \p{Cc}=制御
-        s = re_u.sub(r'[\p{P}\p{S}\p{Z}\p{Cc}]+', '', s)
-    else:
-        import re
-        dash_chars = r'\-\u2212\u2010\u2011\u2012\u2013\u2014\u2015\uFF0D\u30FC\uFF70'
-        pattern = (
-            r'[\s"\'\u201C\u201D\u2018\u2019\(\)\[\]{}<>]'              # 空白と各種引用符・半角括弧
-            r'|[、。・,…:;!?！？／/\\|＋+＊*.,]'                       # 句読点・記号
-            r'|[【】＜＞「」『』《》〔〕［］｛｝（）]'               # 全角括弧
-            r'|[' + dash_chars + r']'                                   # ハイフン・ダッシュ・長音
-        )
-        s = re.sub(pattern, "", s)
-
-    return s
+    # 2) 記号類の除去（C実装の translate。BMP外を含む場合のみ正規表現）
+    if re_u and max(s) > "\uffff":
+        return _DUP_STRIP_RE.sub("", s)
+    return s.translate(_DEL_TABLE)
 
 
 def service_account_client_from_env():
@@ -161,13 +296,29 @@ def service_account_client_from_env():
         print("❌ 環境変数 GOOGLE_CREDENTIALS が設定されていません。", file=sys.stderr)
         sys.exit(2)
     try:
-        info = json.loads(creds_json)
-    except json.JSONDecodeError as e:
+        info = _json_loads(creds_json)
+    except ValueError as e:
         print(f"❌ GOOGLE_CREDENTIALS がJSONとして読み取れません: {e}", file=sys.stderr)
         sys.exit(2)
 
     try:
-        gc = gspread.service_account_from_dict(info)
+        # 書き込み量が多い日の 429 を自動リトライ（指数バックオフ）で吸収する
+        gc = gspread.service_account_from_dict(
+            info, client_factory=gspread.BackoffClient
+        )
+        # TCP+TLS接続を使い回し、API呼び出し毎のハンドシェイクを省く。
+        # 読み取り系の429/5xxはアダプタ側でも Retry-After を尊重して再試行
+        # （書き込みの再試行は二重追記を避けて BackoffClient に任せる）
+        gc.session.mount("https://", HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                respect_retry_after_header=True,
+            ),
+        ))
         return gc
     except Exception as e:
         print(f"❌ Google 認証に失敗: {e}", file=sys.stderr)
@@ -186,59 +337,70 @@ def open_sheet_by_id(gc, spreadsheet_id: str):
 def ensure_output_worksheet(sh_out, title: str):
     """
     出力ワークシート（当日 yymmdd）を確保。無ければ新規作成＋ヘッダ。
+    worksheet(title) の例外往復ではなく、一覧を1回取得して辞書で引く。
     """
-    try:
-        ws = sh_out.worksheet(title)
-    except gspread.WorksheetNotFound:
-        ws = sh_out.add_worksheet(title=title, rows=2000, cols=len(OUTPUT_HEADERS))
+    ws_map = {w.title: w for w in sh_out.worksheets()}
+    ws = ws_map.get(title)
+    if ws is None:
+        # Z1 に NORM_VERSION タグを置くため、グリッドはZ列まで確保しておく
+        ws = sh_out.add_worksheet(title=title, rows=2000, cols=26)
         ws.append_row(OUTPUT_HEADERS, value_input_option="USER_ENTERED")
     return ws
 
 
-def read_existing_urls(ws_out):
+def fetch_output_values(ws_out):
     """
-    既存URL（C列）をセットで返す（ヘッダ除く）
+    出力シートの B2:H（タイトル〜重複確認用タイトル）を1回だけ取得。
+    各関数で get_all_values を繰り返さず、このスナップショットを共有する。
     """
-    values = ws_out.get_all_values()
-    urls = set()
-    for i, row in enumerate(values):
-        if i == 0:
-            continue
-        if len(row) >= 3:
-            url = (row[2] or "").strip()
-            if url:
-                urls.add(url)
-    return urls
+    return ws_out.get("B2:H")
 
 
-def collect_rows_from_input(sh_in, start_jst: datetime, end_jst: datetime):
+def read_existing_urls(values):
     """
-    入力（MSN→Google→Yahoo）から範囲一致を抽出。
-    出力形式: [ソース, タイトル, URL, 投稿日(整形), 引用元, F, G, 正規化タイトル, 有料カテゴリ]
+    既存URL（C列＝スナップショットの2列目）をセットで返す
     """
-    out_rows = []
+    return {row[1].strip() for row in values if len(row) > 1 and row[1].strip()}
 
+
+def iter_rows_from_input(sh_in, start_jst: datetime, end_jst: datetime):
+    """
+    入力（MSN→Google→Yahoo）から範囲一致を逐次yieldするジェネレータ。
+    3シート分を values.batchGet の1リクエストでまとめて読む（シート毎の往復を削減）。
+    出力形式: [ソース, タイトル, URL, 投稿日(整形), 引用元, F, G, 正規化タイトル, 有料カテゴリ]
+    """
+    available = {w.title for w in sh_in.worksheets()}
+    sheet_names = []
     for sheet_name in INPUT_SHEETS:
-        try:
-            ws = sh_in.worksheet(sheet_name)
-        except gspread.WorksheetNotFound:
+        if sheet_name not in available:
             print(f"⚠ 入力側にシート '{sheet_name}' が見つかりません。スキップします。")
             continue
+        sheet_names.append(sheet_name)
+    if not sheet_names:
+        return
 
-        values = ws.get_all_values()
-        if not values:
-            continue
-
-        for i, row in enumerate(values):
-            if i == 0:
-                continue
-            # A:タイトル, B:URL, C:投稿日, D:引用元
-            title = row[0].strip() if len(row) > 0 else ""
-            url = row[1].strip() if len(row) > 1 else ""
-            posted_raw = row[2].strip() if len(row) > 2 else ""
-            source_name = row[3].strip() if len(row) > 3 else ""
-
-            if not title or not url or not posted_raw:
+    # 日付をシリアル値(float)で受け取り、parse側の数値高速パスに乗せる
+    resp = sh_in.values_batch_get(
+        ranges=[f"'{n}'!A2:D" for n in sheet_names],
+        params={
+            "valueRenderOption": "UNFORMATTED_VALUE",
+            "dateTimeRenderOption": "SERIAL_NUMBER",
+        },
+    )
+
+    for sheet_name, vrange in zip(sheet_names, resp.get("valueRanges", [])):
+        values = vrange.get("values") or []
+        for row in values:
+            # A:タイトル, B:URL, C:投稿日, D:引用元（足りない分は一度だけ右詰めで補う）
+            if len(row) < 4:
+                row = row + [""] * (4 - len(row))
+            # UNFORMATTED_VALUE では数値セルが float で返るため str に寄せる
+            title = str(row[0]).strip()
+            url = str(row[1]).strip()
+            posted_raw = row[2]  # 日付シリアル(float)はそのままparseへ
+            source_name = str(row[3]).strip()
+
+            if not title or not url or posted_raw is None or posted_raw == "":
                 continue
 
             posted_dt = parse_sheet_datetime_to_jst(posted_raw)
@@ -248,7 +410,7 @@ def collect_rows_from_input(sh_in, start_jst: datetime, end_jst: datetime):
             if start_jst <= posted_dt <= end_jst:
                 posted_fmt = format_compact_jst(posted_dt)
                 norm_title = normalize_title_for_dup(title)
-                out_rows.append([
+                yield [
                     sheet_name,         # A: ソース（入力元シート名）
                     title,              # B: タイトル
                     url,                # C: URL
@@ -258,45 +420,144 @@ def collect_rows_from_input(sh_in, start_jst: datetime, end_jst: datetime):
                     "",                 # G: カテゴリ（後でAIが埋める）
                     norm_title,         # H: 重複確認用タイトル
                     ""                  # I: 有料カテゴリ
-                ])
+                ]
+
+
+def _title_digest(norm: str) -> str:
+    """正規化タイトルの8バイトハッシュ（タイトル重複の高速判定用）"""
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=8).hexdigest()
 
-    return out_rows
 
+APPEND_CHUNK = 500  # append_rows の1回あたりの行数（メモリとペイロードを抑制）
 
-def append_rows_dedup(ws_out, rows, existing_urls):
+
+def append_rows_dedup(ws_out, rows, existing_urls, values=None):
     """
-    既存URLと重複しないものだけ追記
+    既存URLと重複しないものだけ追記。正規化タイトル（H列）のハッシュでも照合し、
+    同一記事が別URLで再掲されたもの（転載）を弾く。
+    rows はジェネレータでよく、APPEND_CHUNK 件ごとに書き込みながら消費する。
+    追記した行のリストを返す。
     """
-    new_rows = [r for r in rows if (r[2] not in existing_urls)]
+    # 既存H列からハッシュ→正規化タイトルの対応を構築（衝突時のみ実体比較）
+    seen = {}
+    if values:
+        for row in values:
+            norm = row[6] if len(row) > 6 else ""
+            if norm:
+                seen[_title_digest(norm)] = norm
+
+    new_rows = []
+    buf = []
+    scanned = 0
+    for r in rows:
+        scanned += 1
+        if r[2] in existing_urls:
+            continue
+        norm = r[7]
+        if norm:
+            digest = _title_digest(norm)
+            if seen.get(digest) == norm:
+                continue
+            seen[digest] = norm
+        new_rows.append(r)
+        buf.append(r)
+        if len(buf) >= APPEND_CHUNK:
+            ws_out.append_rows(buf, value_input_option="USER_ENTERED")
+            buf = []
+    if buf:
+        ws_out.append_rows(buf, value_input_option="USER_ENTERED")
+
+    print(f"🔎 抽出合計: {scanned} 件")
     if not new_rows:
         print("✅ 追加対象の新規ニュースはありません（すべて既存URLと重複）。")
-        return 0
-    ws_out.append_rows(new_rows, value_input_option="USER_ENTERED")
+        return []
     print(f"📝 追加 {len(new_rows)} 件")
-    return len(new_rows)
+    return new_rows
 
 
-def refresh_h_column_all(ws_out):
+def refresh_h_column_all(ws_out, values, added=0):
     """
-    H列（重複確認用タイトル）を**全行**再計算して上書き。
-    記号の取りこぼしを防ぐため、毎回最新の正規化ルールで更新します。
+    H列（重複確認用タイトル）を再計算して上書き。
+    正規化ルール（NORM_VERSION, Z1セルに記録）が前回と同じで追記も無ければ
+    丸ごとスキップ。再計算時も現在のH値と異なる行だけを連続レンジに
+    まとめて書き込む。
     """
-    values = ws_out.get_all_values()
-    if len(values) <= 1:
+    if not values:
         return
-    updates = []
+    try:
+        tag = ws_out.acell("Z1").value
+    except Exception:
+        tag = None
+    if tag == NORM_VERSION and not added:
+        return
+
+    changed = {}  # row -> (norm,)
     for i, row in enumerate(values):
-        if i == 0:
-            continue
-        row_idx = i + 1
-        title = row[1] if len(row) > 1 else ""
-        norm = normalize_title_for_dup(title)
-        updates.append({"range": f"H{row_idx}", "values": [[norm]]})
-    if updates:
-        ws_out.batch_update(updates, value_input_option="USER_ENTERED")
+        norm = normalize_title_for_dup(row[0] if row else "")
+        cur = row[6] if len(row) > 6 else ""
+        if cur != norm:
+            changed[i + 2] = (norm,)
+
+    if changed:
+        updates = _coalesce_row_updates(changed, "H", "H")
+        # H列は比較用の素のテキスト。RAW でサーバ側の再解釈（数値/日付/数式化）を省く
+        ws_out.batch_update(updates, value_input_option="RAW")
+    if tag != NORM_VERSION:
+        try:
+            ws_out.update_acell("Z1", NORM_VERSION)
+        except Exception as e:
+            # 旧仕様（9列グリッド）のシートではZ1が範囲外。タグ無しでも動作は同じで、
+            # 次回のH列再計算がスキップされないだけなので続行する
+            print(f"⚠ 正規化バージョンタグ(Z1)を書き込めませんでした: {e}")
+
+
+def _coalesce_row_updates(results, first_col, last_col):
+    """
+    {row: (値, ...)} を、連続行をまとめた
+    {"range": "F{a}:G{b}", "values": [[...], ...]} のリストへ変換。
+    """
+    updates = []
+    run_start = prev = None
+    vals = []
+    for row in sorted(results):
+        if run_start is None:
+            run_start = prev = row
+            vals = [list(results[row])]
+        elif row == prev + 1:
+            vals.append(list(results[row]))
+            prev = row
+        else:
+            updates.append({"range": f"{first_col}{run_start}:{last_col}{prev}", "values": vals})
+            run_start = prev = row
+            vals = [list(results[row])]
+    if run_start is not None:
+        updates.append({"range": f"{first_col}{run_start}:{last_col}{prev}", "values": vals})
+    return updates
+
+
+def _open_gemini_cache():
+    """
+    分類結果のローカルキャッシュ（sqlite）を開く。開けない環境では None を返し、
+    キャッシュ無しで続行する。期限切れ（GEMINI_CACHE_TTL_DAYS超）はここで掃除。
+    """
+    try:
+        os.makedirs(os.path.dirname(GEMINI_CACHE_PATH), exist_ok=True)
+        conn = sqlite3.connect(GEMINI_CACHE_PATH)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, sentiment TEXT, category TEXT, ts INTEGER)"
+        )
+        cutoff = int(time.time()) - GEMINI_CACHE_TTL_DAYS * 86400
+        conn.execute("DELETE FROM cache WHERE ts < ?", (cutoff,))
+        conn.commit()
+        return conn
+    except Exception as e:
+        print(f"ℹ Gemini分類キャッシュは利用できません: {e}")
+        return None
 
 
-def classify_with_gemini(ws_out):
+def classify_with_gemini(ws_out, values):
     """
     B列タイトルをもとに、F列（ポジネガ）/ G列（カテゴリ）をGeminiで分類。
     既にF/Gが埋まっている行はスキップ。
@@ -307,25 +568,60 @@ def classify_with_gemini(ws_out):
         return
 
     genai.configure(api_key=api_key)
-    values = ws_out.get_all_values()
-    if len(values) <= 1:
+    if not values:
         return
 
     items = []  # (row_idx, title)
     for i, row in enumerate(values):
-        if i == 0:
-            continue
-        row_idx = i + 1
-        title = row[1] if len(row) > 1 else ""
-        f_val = row[5] if len(row) > 5 else ""
-        g_val = row[6] if len(row) > 6 else ""
+        if len(row) < 6:
+            row = row + [""] * (6 - len(row))
+        title, f_val, g_val = row[0], row[4], row[5]
         if title and (not f_val or not g_val):
-            items.append((row_idx, title))
+            items.append((i + 2, title))
 
     if not items:
         print("ℹ 分類対象の行はありません。")
         return
 
+    # 同一記事がMSN/Google/Yahooに重複して載るため、正規化タイトル単位で1回だけ
+    # 分類し、結果を同じタイトルの全行へ展開する（Gemini呼び出し削減）
+    groups = {}   # 代表row -> [row, ...]
+    by_norm = {}  # 正規化タイトル -> 代表row
+    uniq_items = []  # (代表row, title)
+    for row_idx, title in items:
+        norm = normalize_title_for_dup(title)
+        rep = by_norm.get(norm)
+        if rep is None:
+            by_norm[norm] = row_idx
+            groups[row_idx] = [row_idx]
+            uniq_items.append((row_idx, title))
+        else:
+            groups[rep].append(row_idx)
+    items = uniq_items
+
+    # ローカルキャッシュ命中分はGeminiに投げずに即反映
+    results = {}     # row -> (sentiment, category)
+    cache = _open_gemini_cache()
+    norm_keys = {}   # 代表row -> キャッシュキー
+    if cache is not None:
+        remaining = []
+        for row_idx, title in items:
+            key = hashlib.sha256(
+                normalize_title_for_dup(title).encode("utf-8")
+            ).hexdigest()
+            norm_keys[row_idx] = key
+            hit = cache.execute(
+                "SELECT sentiment, category FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if hit:
+                for target_row in groups.get(row_idx, [row_idx]):
+                    results[target_row] = (hit[0], hit[1])
+            else:
+                remaining.append((row_idx, title))
+        if len(remaining) < len(items):
+            print(f"♻ キャッシュ命中: {len(items) - len(remaining)} 件")
+        items = remaining
+
     # ====== ここが差し替えたプロンプト ======
     system_prompt = """
 あなたは敏腕雑誌記者です。Webニュースのタイトルを以下の規則で厳密に分類してください。
@@ -357,21 +653,32 @@ def classify_with_gemini(ws_out):
     # =====================================
 
     BATCH = 40
-    updates = []
-    for start in range(0, len(items), BATCH):
-        batch = items[start : start + BATCH]
+    model = genai.GenerativeModel(
+        "gemini-1.5-flash", generation_config=_GEMINI_GENERATION_CONFIG
+    )
+
+    def classify_batch(batch):
+        """
+        1バッチ分を分類して {代表row: (sentiment, category)} を返す。失敗時は空dict。
+        """
         payload = [{"row": r, "title": t} for (r, t) in batch]
+        out = {}
         try:
-            model = genai.GenerativeModel("gemini-1.5-flash")
-            prompt = system_prompt + "\n\n" + json.dumps(payload, ensure_ascii=False, indent=2)
-            resp = model.generate_content(prompt)
-            text = (resp.text or "").strip()
-
-            # JSON抽出（応答に前後文が混ざる保険）
-            import re as re_std
-            m = re_std.search(r"\[.*\]", text, flags=re_std.DOTALL)
-            json_text = m.group(0) if m else text
-            result = json.loads(json_text)
+            # indent無し（モデルには不要でプロンプトのバイト数が減る）
+            prompt = system_prompt + "\n\n" + _json_dumps(payload)
+            resp = None
+            for attempt in range(3):
+                try:
+                    resp = model.generate_content(prompt)
+                    break
+                except Exception as e:
+                    # 並行実行中のレート制限(429)のみ指数バックオフ+ジッタで再試行
+                    if attempt < 2 and "429" in str(e):
+                        time.sleep(random.uniform(0, 2.0 * (2 ** attempt)))
+                        continue
+                    raise
+            # response_schema 指定により応答はそのままJSON配列
+            result = _json_loads(resp.text or "[]")
 
             for obj in result:
                 try:
@@ -391,16 +698,35 @@ def classify_with_gemini(ws_out):
                     else:
                         sentiment = "ニュートラル"
 
-                updates.append({
-                    "range": f"F{row_idx}:G{row_idx}",   # F=ポジネガ, G=カテゴリ
-                    "values": [[sentiment, category]]
-                })
+                out[row_idx] = (sentiment, category)
         except Exception as e:
             print(f"⚠ Gemini応答の解析に失敗: {e}")
-
-    if updates:
-        ws_out.batch_update(updates, value_input_option="USER_ENTERED")
-        print(f"✨ Gemini分類を {len(updates)} 行に反映しました。")
+        return out
+
+    # HTTP往復がバッチ数ぶん直列に並ぶのを避け、数バッチを並行実行する
+    batches = [items[s : s + BATCH] for s in range(0, len(items), BATCH)]
+    now_ts = int(time.time())
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        for batch_result in executor.map(classify_batch, batches):
+            for row_idx, (sentiment, category) in batch_result.items():
+                # 同じタイトルの全行に同じ結果を反映
+                for target_row in groups.get(row_idx, [row_idx]):
+                    results[target_row] = (sentiment, category)
+                if cache is not None and row_idx in norm_keys:
+                    cache.execute(
+                        "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                        (norm_keys[row_idx], sentiment, category, now_ts),
+                    )
+    if cache is not None:
+        cache.commit()
+        cache.close()
+
+    if results:
+        # 連続する行番号を1つの F{a}:G{b} レンジにまとめてリクエスト数を抑える
+        updates = _coalesce_row_updates(results, "F", "G")
+        # F/G も固定語彙のテキストなので RAW で十分
+        ws_out.batch_update(updates, value_input_option="RAW")
+        print(f"✨ Gemini分類を {len(results)} 行に反映しました。")
     else:
         print("ℹ Gemini分類の更新はありませんでした。")
 
@@ -417,25 +743,29 @@ def main():
     sh_in = open_sheet_by_id(gc, INPUT_SPREADSHEET_ID)
     sh_out = open_sheet_by_id(gc, OUTPUT_SPREADSHEET_ID)
 
-    # 入力から抽出
-    extracted = collect_rows_from_input(sh_in, start_jst, end_jst)
-    print(f"🔎 抽出合計: {len(extracted)} 件")
+    # 入力から抽出（ジェネレータ。append_rows_dedup 側で消費しながら書き込む）
+    extracted = iter_rows_from_input(sh_in, start_jst, end_jst)
 
     # 出力ワークシート確保
     ws_out = ensure_output_worksheet(sh_out, date_sheet)
 
+    # 出力シートは1回だけ読み、以降はスナップショットを共有する
+    values = fetch_output_values(ws_out)
+
     # 既存URL収集（C列）
-    existing = read_existing_urls(ws_out)
+    existing = read_existing_urls(values)
     print(f"🧮 既存URL数: {len(existing)} 件")
 
-    # 追記（重複除外）
-    added = append_rows_dedup(ws_out, extracted, existing)
+    # 追記（重複除外）。追記分は再取得せずスナップショットへ反映
+    added_rows = append_rows_dedup(ws_out, extracted, existing, values)
+    values.extend(r[1:8] for r in added_rows)
+    added = len(added_rows)
 
-    # H列を毎回**全行**再計算（正規化ルールの最新反映）
-    refresh_h_column_all(ws_out)
+    # H列を再計算（正規化ルール変更時 or 追記時のみ、差分行だけ書き込み）
+    refresh_h_column_all(ws_out, values, added)
 
     # Gemini分類（F/G列を埋める）
-    classify_with_gemini(ws_out)
+    classify_with_gemini(ws_out, values)
 
     print("✅ 完了")
     if added: